@@ -3,7 +3,9 @@
 Command line utility to list and filter TTYs
 """
 import argparse
+import functools
 import json
+import operator
 import os
 import re
 import sys
@@ -11,46 +13,104 @@ import time
 
 import pyudev
 
-
+UDEV_CONTEXT = pyudev.Context()
+
+# Fields of tty2dict() that are taken verbatim from a udev property. Filters on
+# these can be checked before the TTY is parsed.
+RAW_PROPERTIES = {
+    "serial": "ID_SERIAL_SHORT",
+    "driver": "ID_USB_DRIVER",
+    "model_db": "ID_MODEL_FROM_DATABASE",
+    "vendor_db": "ID_VENDOR_FROM_DATABASE",
+}
+
+FORMATS_COMBINABLE = frozenset({
+    "path",
+    "serial",
+    "vendor",
+    "vendor_db",
+    "model",
+    "model_db",
+    "driver",
+    "ctime",
+    "iface_num",
+})
+FORMATS_UNCOMBINABLE = frozenset({
+    "table",
+    "json",
+})
+SUPPORTED_FORMATS = FORMATS_COMBINABLE | FORMATS_UNCOMBINABLE
+
+# Number of lines to collect before writing them out when streaming results
+OUTPUT_BATCH_LINES = 64
+
+
+@functools.lru_cache(maxsize=256)
 def unescape(string):
     """
     Decodes unicode escaping in a string, e.g. "Hallo\\x20World" is decoded as
     "Hallo World"
+
+    Results are cached, as boards of the same kind share vendor and model.
     """
+    if "\\" not in string:
+        # nothing escaped, decoding would return the string unchanged
+        return string
+
     res = bytes(string, "utf8").decode("unicode_escape")
     res = res.encode("latin1").decode("utf8", errors="replace")
     return res
 
 
-def tty2dict(dev):
+def tty2dict(props):
     """
-    Parse the given TTY udev interface into a dict() containing the most
-    relevant attributes
+    Parse the given udev properties (pyudev.Device.properties) of a TTY
+    interface into a dict() containing the most relevant attributes
+
+    The "ctime" attribute requires a stat() call and is only a placeholder
+    here, use add_ctime() to fill it in when needed.
     """
     result = {}
-    result["path"] = dev.get("DEVNAME")
-    result["ctime"] = os.stat(result["path"]).st_ctime
-    result["serial"] = dev.get("ID_SERIAL_SHORT")
-    result["driver"] = dev.get("ID_USB_DRIVER")
-    result["model"] = unescape(dev.get("ID_MODEL_ENC"))
-    result["model_db"] = dev.get("ID_MODEL_FROM_DATABASE")
-    result["vendor"] = unescape(dev.get("ID_VENDOR_ENC"))
-    result["vendor_db"] = dev.get("ID_VENDOR_FROM_DATABASE")
-    result["iface_num"] = str(int(dev.get("ID_USB_INTERFACE_NUM")))
+    result["path"] = props.get("DEVNAME")
+    result["ctime"] = None
+    result["serial"] = props.get("ID_SERIAL_SHORT")
+    result["driver"] = props.get("ID_USB_DRIVER")
+    result["model"] = unescape(props.get("ID_MODEL_ENC"))
+    result["model_db"] = props.get("ID_MODEL_FROM_DATABASE")
+    result["vendor"] = unescape(props.get("ID_VENDOR_ENC"))
+    result["vendor_db"] = props.get("ID_VENDOR_FROM_DATABASE")
+    result["iface_num"] = str(int(props.get("ID_USB_INTERFACE_NUM")))
 
     return result
 
 
+def add_ctime(tty):
+    """
+    Fill in the "ctime" attribute of the given TTY dict and return the dict
+    """
+    tty["ctime"] = os.stat(tty["path"]).st_ctime
+    return tty
+
+
+def needs_ctime(args):
+    """
+    Check if the "ctime" attribute of the TTYs is printed with the given args
+    """
+    return any(fmt in ("ctime", "table", "json") for fmt in args.format)
+
+
 def filters_match(filters, tty):
     """
     Check if the given TTY interface matches all given filters
-    """
 
-    for key, regex in filters:
-        if tty[key] is None:
-            return False
+    Regular expressions are only anchored at the start of the value, so that
+    e.g. a filter "J-Link" also matches a model "J-Link Plus". Mismatches are
+    still rejected as soon as the leading characters differ.
+    """
 
-        if not regex.match(tty[key]):
+    for key, predicate in filters:
+        value = tty[key]
+        if value is None or not predicate(value):
             return False
 
     return True
@@ -61,29 +121,13 @@ def parse_args(args):
     Parse the given command line style arguments with argparse
     """
     desc = "List and filter TTY interfaces that might belong to boards"
-    formats_combinable = {
-        "path",
-        "serial",
-        "vendor",
-        "vendor_db",
-        "model",
-        "model_db",
-        "driver",
-        "ctime",
-        "iface_num",
-    }
-    formats_uncombinable = {
-        "table",
-        "json",
-    }
-    supported_formats = formats_combinable.union(formats_uncombinable)
     parser = argparse.ArgumentParser(description=desc)
     parser.add_argument("--most-recent", action="store_true",
                         help="Print only the most recently connected matching "
                              + "TTY")
     parser.add_argument("--format", default=["table"], type=str, nargs='+',
                         help=f"How to format the TTYs. Supported formats: "
-                             f"{sorted(supported_formats)}")
+                             f"{sorted(SUPPORTED_FORMATS)}")
     parser.add_argument("--format-sep", default=" ", type=str,
                         help="Separator between formats (default: space)")
     parser.add_argument("--serial", default=None, type=str,
@@ -114,12 +158,12 @@ def parse_args(args):
     args = parser.parse_args()
 
     if len(args.format) == 1:
-        if args.format[0] not in supported_formats:
+        if args.format[0] not in SUPPORTED_FORMATS:
             sys.exit(f"Format \"{args.format[0]}\" not supported")
     else:
         for fmt in args.format:
-            if fmt not in formats_combinable:
-                if fmt in formats_uncombinable:
+            if fmt not in FORMATS_COMBINABLE:
+                if fmt in FORMATS_UNCOMBINABLE:
                     sys.exit(f"Format \"{fmt}\" cannot be combined with " +
                              "other formats")
                 else:
@@ -134,126 +178,181 @@ def parse_args(args):
     return args
 
 
+def write_lines(lines):
+    """
+    Write the given lines to stdout with a single call and flush it
+    """
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+        sys.stdout.flush()
+
+
 def print_table(data, headers):
     """
     Print the list of dictionaries given in data as table, where headers is
     a list of keys to that dict and also servers as table headers.
     """
-    lengths = []
-    for header in headers:
-        lengths.append(len(header))
-
-    for item in data:
-        for i, header in enumerate(headers):
-            if len(str(item[header])) > lengths[i]:
-                lengths[i] = len(item[header])
-
-    sys.stdout.write(f"{headers[0]:{lengths[0]}}")
-    for i in range(1, len(headers)):
-        sys.stdout.write(f" | {headers[i]:{lengths[i]}}")
-    sys.stdout.write("\n" + lengths[0] * "-")
-    for i in range(1, len(headers)):
-        sys.stdout.write("-|-" + lengths[i] * "-")
+    # fetch all cells of a row at once and convert each to str only once
+    if len(headers) > 1:
+        cells = operator.itemgetter(*headers)
+    else:
+        # itemgetter() returns the bare value instead of a tuple for one key
+        def cells(item):
+            return (item[headers[0]],)
+    rows = [[str(cell) for cell in cells(item)] for item in data]
+    lengths = [max(map(len, column)) for column in zip(headers, *rows)]
 
-    for item in data:
-        sys.stdout.write(f"\n{str(item[headers[0]]):{lengths[0]}}")
-        for header, length in zip(headers[1:], lengths[1:]):
-            sys.stdout.write(f" | {str(item[header]):{length}}")
+    lines = []
+    lines.append(" | ".join(f"{header:{length}}"
+                            for header, length in zip(headers, lengths)))
+    lines.append("-|-".join(length * "-" for length in lengths))
+    for row in rows:
+        lines.append(" | ".join(f"{cell:{length}}"
+                                for cell, length in zip(row, lengths)))
 
-    sys.stdout.write("\n")
-    sys.stdout.flush()
+    # write the whole table at once rather than cell by cell
+    write_lines(lines)
 
 
 def print_results(args, ttys):
     """
     Print the given TTY devices according to the given args
+
+    ttys may be any iterable. Except for the json and table formats, which
+    need all TTYs at once, the TTYs are printed while iterating. Returns
+    whether at least one TTY was printed.
     """
-    if len(args.format) == 1:
+    if len(args.format) == 1 and args.format[0] in FORMATS_UNCOMBINABLE:
+        ttys = list(ttys)
+        if len(ttys) == 0:
+            return False
+
         if args.format[0] == "json":
             print(json.dumps(ttys, indent=2))
-            return
+            return True
 
         if args.format[0] == "table":
+            # the interfaces of one device usually share the same ctime, so
+            # format each second only once
+            ctimes = {}
+            rows = []
             for tty in ttys:
-                tty["ctime"] = time.strftime("%H:%M:%S",
-                                             time.localtime(tty["ctime"]))
+                seconds = int(tty["ctime"])
+                if seconds not in ctimes:
+                    ctimes[seconds] = time.strftime("%H:%M:%S",
+                                                    time.localtime(seconds))
+                # leave the given TTY dict untouched
+                rows.append({**tty, "ctime": ctimes[seconds]})
             headers = ["path", "driver", "vendor", "model", "model_db",
                        "serial", "ctime", "iface_num"]
-            print_table(ttys, headers)
-            return
+            print_table(rows, headers)
+            return True
 
+    sep = args.format_sep
+    printed = 0
+    lines = []
     for tty in ttys:
-        line = ""
+        items = []
         for fmt in args.format:
             item = tty[fmt]
-            if item.rfind(args.format_sep) >= 0:
+            if sep in item:
                 # item contains separator --> quote it
                 # using json.dumps to also escape quotation chars and other
                 # unsafe stuff
                 item = json.dumps(item)
-            line += f"{args.format_sep}{item}"
-        print(line[len(args.format_sep):])
+            items.append(item)
+        lines.append(sep.join(items))
+        if len(lines) >= OUTPUT_BATCH_LINES:
+            write_lines(lines)
+            printed += len(lines)
+            lines = []
+
+    write_lines(lines)
+    printed += len(lines)
+    return printed > 0
 
 
 def generate_filters(args):
     """
     Generate filters for use in the filters_match function from the command
     line arguments
+
+    Each filter is a tuple (key, predicate), where predicate is called with
+    the value of the TTY attribute key and returns whether it matches. The
+    serial is compared literally, all other filters use the match() method of
+    the compiled regex. The filters are ordered so that the cheap and most
+    selective ones come first, with the long model and vendor strings being
+    last. Driver names and interface numbers are always ASCII, so their
+    regexes are compiled with re.ASCII.
     """
     result = []
     if args.serial is not None:
-        result.append(("serial", re.compile(r"^" + re.escape(args.serial)
-                       + r"$")))
+        serial = args.serial
+        result.append(("serial", lambda value: value == serial))
 
-    if args.driver is not None:
-        result.append(("driver", re.compile(args.driver)))
+    if args.iface_num is not None:
+        regex = re.compile(args.iface_num, re.ASCII)
+        result.append(("iface_num", regex.match))
 
-    if args.model is not None:
-        result.append(("model", re.compile(args.model)))
+    if args.driver is not None:
+        result.append(("driver", re.compile(args.driver, re.ASCII).match))
 
     if args.model_db is not None:
-        result.append(("model_db", re.compile(args.model_db)))
-
-    if args.vendor is not None:
-        result.append(("vendor", re.compile(args.vendor)))
+        result.append(("model_db", re.compile(args.model_db).match))
 
     if args.vendor_db is not None:
-        result.append(("vendor_db", re.compile(args.vendor_db)))
+        result.append(("vendor_db", re.compile(args.vendor_db).match))
 
-    if args.iface_num is not None:
-        result.append(("iface_num", re.compile(args.iface_num)))
+    if args.model is not None:
+        result.append(("model", re.compile(args.model).match))
+
+    if args.vendor is not None:
+        result.append(("vendor", re.compile(args.vendor).match))
 
     return result
 
 
+def matching_ttys(args):
+    """
+    Yield the TTYs not excluded and matching all filters of the given parsed
+    command line arguments, without their ctime filled in
+    """
+    filters = generate_filters(args)
+    raw_filters = [f for f in filters if f[0] in RAW_PROPERTIES]
+    parsed_filters = [f for f in filters if f[0] not in RAW_PROPERTIES]
+
+    for dev in UDEV_CONTEXT.list_devices(subsystem='tty', ID_BUS='usb'):
+        props = dev.properties
+        if props.get(RAW_PROPERTIES["serial"]) in args.exclude_serial:
+            continue
+        # reject TTYs on the raw udev properties before parsing them
+        raw = {key: props.get(RAW_PROPERTIES[key]) for key, _ in raw_filters}
+        if not filters_match(raw_filters, raw):
+            continue
+        tty = tty2dict(props)
+        if filters_match(parsed_filters, tty):
+            yield tty
+
+
 def print_ttys(args):
     """
     Print ttys as specified by the given command line arguments
     """
     args = parse_args(args)
-    filters = generate_filters(args)
-
-    ttys = []
-    for dev in pyudev.Context().list_devices(subsystem='tty', ID_BUS='usb'):
-        tty = tty2dict(dev)
-        if tty["serial"] not in args.exclude_serial and filters_match(filters, tty):
-            ttys.append(tty)
 
     if args.most_recent:
-        if len(ttys) > 0:
-            most_recent = ttys[0]
-            for tty in ttys:
-                if tty["ctime"] > most_recent["ctime"]:
-                    most_recent = tty
-            ttys = [most_recent]
-        else:
-            ttys = []
+        # only keep the most recent TTY seen so far while enumerating
+        most_recent = max(map(add_ctime, matching_ttys(args)),
+                          key=lambda tty: tty["ctime"], default=None)
+        ttys = [] if most_recent is None else [most_recent]
+    else:
+        ttys = matching_ttys(args)
+        if needs_ctime(args):
+            ttys = map(add_ctime, ttys)
 
-    if len(ttys) == 0:
+    if not print_results(args, ttys):
         sys.exit(1)
 
-    print_results(args, ttys)
-
 
 if __name__ == "__main__":
     print_ttys(sys.argv)